@@ -8,8 +8,258 @@ import re
 import warnings
 import random
 import tempfile
+import shutil
+import threading
+from collections import OrderedDict
 from multiprocessing import Pool, cpu_count
 
+import numpy as np
+from numba import njit
+
+# caps on the caches; code corpora repeat words and whole lines (imports,
+# boilerplate) so hits are frequent, but unique entries must not grow
+# the caches without bound
+MAX_WORD_CACHE = 500000
+MAX_LINE_CACHE = 200000
+
+
+class _LRUCache(object):
+    """bounded mapping with least-recently-used eviction; a lock around
+    every operation keeps it safe to share between threads"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._data[key]
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            data = self._data
+            if key in data:
+                data.move_to_end(key)
+            data[key] = value
+            if len(data) > self.maxsize:
+                data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+# odd Fibonacci multiplier used to scramble pair keys into table slots;
+# the Python-side insert in _build_pair_table must use the same constant
+HASH_MULT = 11400714819323198485
+
+
+@njit(cache=True)
+def _pair_lookup(keys, vals, key):
+    """probe the open-addressing pair table; -1 means absent"""
+    mask = keys.shape[0] - 1
+    i = np.int64(np.uint64(key) * np.uint64(HASH_MULT) & np.uint64(mask))
+    while True:
+        k = keys[i]
+        if k == key:
+            return vals[i]
+        if k == -1:
+            return np.int64(-1)
+        i = (i + 1) & mask
+
+
+@njit(cache=True)
+def _heap_push(heap, size, val):
+    heap[size] = val
+    i = size
+    while i > 0:
+        parent = (i - 1) >> 1
+        if heap[parent] <= heap[i]:
+            break
+        heap[parent], heap[i] = heap[i], heap[parent]
+        i = parent
+    return size + 1
+
+
+@njit(cache=True)
+def _heap_pop(heap, size):
+    top = heap[0]
+    size -= 1
+    heap[0] = heap[size]
+    i = 0
+    while True:
+        left = 2 * i + 1
+        if left >= size:
+            break
+        child = left
+        right = left + 1
+        if right < size and heap[right] < heap[left]:
+            child = right
+        if heap[i] <= heap[child]:
+            break
+        heap[i], heap[child] = heap[child], heap[i]
+        i = child
+    return top, size
+
+
+# single-character symbols use their codepoint as id, so the initial
+# character split is a plain ord() map with no dict lookups; multi-char
+# symbols are interned above the Unicode range
+CHAR_ID_BASE = 0x110000
+
+# int64 lanes per word slot in the reusable kernel workspace: symbol,
+# next, prev, alive, plus three heap slots (n-1 initial pairs and at most
+# two pushes per merge)
+WS_LANES = 7
+
+
+@njit(cache=True)
+def _bpe_encode_nb(ws, n, pair_keys, pair_vals):
+    """Apply BPE merges to a word of n int64 symbol ids in ws[:n].
+
+    pair_keys/pair_vals form an open-addressing hash table mapping
+    (left_id<<32)|right_id to (rank<<32)|merged_id.
+    The word is kept as a doubly linked list and candidate merges in a
+    min-heap of (rank<<32)|position entries, so each merge only costs
+    the two neighbour-pair pushes instead of a full rescan: O(n log n)
+    per word instead of O(n^2). Stale heap entries (their pair was
+    destroyed by an earlier merge) are detected by re-deriving the rank
+    and skipped lazily. Works entirely on integer arrays so no Python
+    objects cross the JIT boundary. All state lives in the caller-owned
+    workspace ws (WS_LANES int64 lanes per slot), so nothing is
+    allocated per word. Writes the surviving ids back to ws[:result]
+    and returns result.
+    """
+    if n <= 1:
+        return n
+
+    cap = ws.shape[0] // WS_LANES
+    sym = ws[:cap]
+    nxt = ws[cap:2 * cap]
+    prv = ws[2 * cap:3 * cap]
+    alive = ws[3 * cap:4 * cap]
+    heap = ws[4 * cap:]
+
+    for i in range(n):
+        nxt[i] = i + 1
+        prv[i] = i - 1
+        alive[i] = 1
+    nxt[n - 1] = -1
+
+    hsize = 0
+    for i in range(n - 1):
+        packed = _pair_lookup(pair_keys, pair_vals, (sym[i] << 32) | sym[i + 1])
+        if packed >= 0:
+            hsize = _heap_push(heap, hsize, ((packed >> 32) << 32) | i)
+
+    while hsize > 0:
+        entry, hsize = _heap_pop(heap, hsize)
+        rank = entry >> 32
+        p = entry & 0xFFFFFFFF
+        if not alive[p]:
+            continue
+        q = nxt[p]
+        if q == -1 or not alive[q]:
+            continue
+        packed = _pair_lookup(pair_keys, pair_vals, (sym[p] << 32) | sym[q])
+        if packed < 0 or (packed >> 32) != rank:
+            # entry refers to a pair that has since been merged away
+            continue
+
+        # merge q into p and splice it out of the list
+        sym[p] = packed & 0xFFFFFFFF
+        alive[q] = 0
+        r = nxt[q]
+        nxt[p] = r
+        if r != -1:
+            prv[r] = p
+
+        # only the two pairs touching the merged node are new
+        l = prv[p]
+        if l != -1:
+            packed = _pair_lookup(pair_keys, pair_vals, (sym[l] << 32) | sym[p])
+            if packed >= 0:
+                hsize = _heap_push(heap, hsize, ((packed >> 32) << 32) | l)
+        if r != -1:
+            packed = _pair_lookup(pair_keys, pair_vals, (sym[p] << 32) | sym[r])
+            if packed >= 0:
+                hsize = _heap_push(heap, hsize, ((packed >> 32) << 32) | p)
+
+    # compact the surviving symbols back into ws[:j]; j never overtakes p,
+    # so writing into sym while walking it is safe
+    j = 0
+    p = 0
+    while p != -1:
+        q = nxt[p]
+        sym[j] = sym[p]
+        j += 1
+        p = q
+    return j
+
+
+@njit(cache=True)
+def _bpe_encode_batch_nb(flat, offsets, pair_keys, pair_vals, out_lens):
+    """Encode a batch of words packed back to back in flat.
+
+    Word w occupies flat[offsets[w]:offsets[w+1]]; surviving ids are
+    written back in place and their count into out_lens. One call per
+    token sequence amortizes the Python->JIT boundary over all words.
+    Deliberately not prange-parallel: numba's threading layers do not
+    survive the fork()s of the process_lines worker pool (the process
+    hangs at exit), and the pool already keeps every core busy.
+    """
+    for w in range(offsets.shape[0] - 1):
+        b = offsets[w]
+        n = offsets[w + 1] - b
+        ws = np.empty(WS_LANES * n, dtype=np.int64)
+        for i in range(n):
+            ws[i] = flat[b + i]
+        m = _bpe_encode_nb(ws, n, pair_keys, pair_vals)
+        for i in range(m):
+            flat[b + i] = ws[i]
+        out_lens[w] = m
+
+
+def _trie_pattern(words):
+    """Build a regex alternation over literal words with shared prefixes
+    factored into a trie ('the'|'then' -> 'the(?:n)?'), so the engine
+    walks each common prefix once instead of backtracking per alternate."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = None  # end-of-word marker
+
+    def emit(node):
+        has_end = '' in node
+        alts = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch != '']
+        if not alts:
+            return ''
+        if has_end:
+            return '(?:' + '|'.join(alts) + ')?'
+        if len(alts) == 1:
+            return alts[0]
+        return '(?:' + '|'.join(alts) + ')'
+
+    return emit(trie)
+
 
 class BPE(object):
     def __init__(self, codes, merges=-1, separator='@@', vocab=None, glossaries=None):
@@ -38,7 +288,7 @@ class BPE(object):
         # some hacking to deal with duplicates (only consider first instance)
         self.bpe_codes = dict([(code, i) for (i, code) in reversed(list(enumerate(self.bpe_codes)))])
 
-        self.bpe_codes_reverse = dict([(pair[0] + pair[1], pair) for pair, i in self.bpe_codes.items()])
+        self._bpe_codes_reverse = None
 
         self.separator = separator
 
@@ -46,17 +296,251 @@ class BPE(object):
 
         self.glossaries = glossaries if glossaries else []
 
-        self.glossaries_regex = re.compile('^({})$'.format('|'.join(glossaries))) if glossaries else None
-
-        self.cache = {}
-
+        # literal glossaries are folded into one prefix-sharing trie pattern
+        # so the alternation never backtracks over common heads; glossaries
+        # that are real regexes stay as their own alternates
+        literal_glossaries = [g for g in self.glossaries if re.escape(g) == g]
+        pattern_glossaries = [g for g in self.glossaries if re.escape(g) != g]
+        parts = []
+        if literal_glossaries:
+            parts.append(_trie_pattern(literal_glossaries))
+        parts.extend('(?:{})'.format(g) for g in pattern_glossaries)
+        combined = '|'.join(parts)
+
+        # anchoring is done with fullmatch instead of ^...$ so the pattern
+        # stays a plain alternation; DOTALL keeps '.' in user patterns from
+        # silently failing on unusual input
+        self.glossaries_regex = re.compile('({})'.format(combined), re.DOTALL) if glossaries else None
+
+        # one combined automaton pass decides whether a word contains any
+        # glossary at all; only hits walk the per-glossary patterns, which
+        # are compiled once here instead of per word in isolate_glossary
+        self._gloss_search = re.compile(combined) if glossaries else None
+        # plain-literal glossaries (no regex metacharacters) are isolated
+        # with a str.find loop; only real patterns keep the regex machinery
+        self._gloss_res = [g if re.escape(g) == g else
+                           (re.compile('^' + g + '$'), re.compile(g), re.compile('({})'.format(g)))
+                           for g in self.glossaries]
+
+        self.cache = _LRUCache(MAX_WORD_CACHE)
+
+        self.line_cache = _LRUCache(MAX_LINE_CACHE)
+
+        self._gloss_cache = _LRUCache(MAX_WORD_CACHE)
+
+        self._build_pair_table()
+
+
+    @property
+    def bpe_codes_reverse(self):
+        """reverse lookup merged symbol -> (left, right); only the
+        vocabulary filter needs it, so it is built on first use"""
+        if self._bpe_codes_reverse is None:
+            self._bpe_codes_reverse = dict([(pair[0] + pair[1], pair) for pair, i in self.bpe_codes.items()])
+        return self._bpe_codes_reverse
+
+    def _build_pair_table(self):
+        """intern every subword seen in the merge table and build the integer
+        pair->rank table for the numba kernel"""
+        self._str_to_id = {}
+        self._id_to_str = []
+        self._id_to_plain = []
+        entries = []
+        for (left, right), rank in self.bpe_codes.items():
+            l = self._intern(left)
+            r = self._intern(right)
+            merged = self._intern(left + right)
+            entries.append(((l << 32) | r, (rank << 32) | merged))
+        self._eow_id = self._intern('</w>')
+        self._ws = np.empty(WS_LANES * 64, dtype=np.int64)
+
+        # pick the word builder for this codes version once, instead of
+        # re-testing self.version for every word
+        if self.version == (0, 1):
+            self._word_ids = self._word_ids_v01
+        elif self.version == (0, 2):
+            self._word_ids = self._word_ids_v02
+        else:
+            raise NotImplementedError
+
+        # flat open-addressing table (linear probing, load factor <= 0.5);
+        # plain int64 arrays probe faster inside the kernel than a numba
+        # typed.Dict and pickle/rebuild cheaply
+        size = 64
+        while size < 2 * len(entries):
+            size *= 2
+        mask = size - 1
+        keys = np.full(size, -1, dtype=np.int64)
+        vals = np.empty(size, dtype=np.int64)
+        for key, val in entries:
+            i = (key * HASH_MULT) & mask
+            while keys[i] != -1:
+                i = (i + 1) & mask
+            keys[i] = key
+            vals[i] = val
+        self._pair_keys = keys
+        self._pair_vals = vals
+
+    def __getstate__(self):
+        # ship only the codes dict to worker processes; the reverse table,
+        # the numba pair table and the caches are rebuilt on unpickling
+        state = self.__dict__.copy()
+        for key in ('_bpe_codes_reverse', 'cache', 'line_cache', '_gloss_cache',
+                    '_str_to_id', '_id_to_str', '_id_to_plain', '_pair_keys',
+                    '_pair_vals', '_eow_id', '_ws', '_word_ids'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bpe_codes_reverse = None
+        self.cache = _LRUCache(MAX_WORD_CACHE)
+        self.line_cache = _LRUCache(MAX_LINE_CACHE)
+        self._gloss_cache = _LRUCache(MAX_WORD_CACHE)
+        self._build_pair_table()
+
+    def _intern(self, symbol):
+        if len(symbol) == 1:
+            return ord(symbol)
+        sid = self._str_to_id.get(symbol)
+        if sid is None:
+            sid = CHAR_ID_BASE + len(self._id_to_str)
+            self._str_to_id[symbol] = sid
+            self._id_to_str.append(symbol)
+            # parallel array with the end-of-word marker already stripped,
+            # so translating a word back needs no per-word endswith/slice
+            self._id_to_plain.append(symbol[:-4] if symbol.endswith('</w>') else symbol)
+        return sid
+
+    def _word_ids_v01(self, orig):
+        """translate a word to its symbol ids, '</w>' appended"""
+        word_ids = list(map(ord, orig))
+        word_ids.append(self._eow_id)
+        return word_ids
+
+    def _word_ids_v02(self, orig):
+        """translate a word to its symbol ids, '</w>' folded into the last symbol"""
+        word_ids = list(map(ord, orig[:-1]))
+        word_ids.append(self._intern(orig[-1] + '</w>'))
+        return word_ids
+
+    def _translate_out(self, orig, out_ids):
+        """turn surviving symbol ids back into the cached subword tuple"""
+        # don't print end-of-word symbols; _id_to_plain has '</w>' already
+        # stripped, so only the id of the final symbol needs special-casing
+        id_to_str = self._id_to_str
+        base = CHAR_ID_BASE
+        if out_ids[-1] == self._eow_id:
+            word = tuple(chr(i) if i < base else id_to_str[i - base] for i in out_ids[:-1])
+        else:
+            last = out_ids[-1]
+            word = tuple(chr(i) if i < base else id_to_str[i - base] for i in out_ids[:-1]) \
+                + (chr(last) if last < base else self._id_to_plain[last - base],)
+
+        if self.vocab:
+            word = check_vocab_and_split(word, self.bpe_codes_reverse, self.vocab, self.separator)
+
+        self.cache[orig] = word
+        return word
+
+    def _encode_batch(self, segments):
+        """encode several uncached words with a single parallel kernel call"""
+        flat_ids = []
+        offsets = np.empty(len(segments) + 1, dtype=np.int64)
+        offsets[0] = 0
+        for k, orig in enumerate(segments):
+            flat_ids.extend(self._word_ids(orig))
+            offsets[k + 1] = len(flat_ids)
+
+        flat = np.array(flat_ids, dtype=np.int64)
+        out_lens = np.empty(len(segments), dtype=np.int64)
+        _bpe_encode_batch_nb(flat, offsets, self._pair_keys, self._pair_vals, out_lens)
+
+        for k, orig in enumerate(segments):
+            begin = offsets[k]
+            self._translate_out(orig, flat[begin:begin + out_lens[k]].tolist())
+
+    def _encode_fast(self, orig):
+        """encode() hot path: run the merge loop in the compiled kernel"""
+        cache = self.cache
+        cached = cache.get(orig)
+        if cached is not None:
+            return cached
+
+        if self.glossaries_regex and self.glossaries_regex.fullmatch(orig):
+            cache[orig] = (orig,)
+            return (orig,)
+
+        if len(orig) == 1:
+            return orig
+
+        word_ids = self._word_ids(orig)
+
+        m = len(word_ids)
+        ws = self._ws
+        if ws.shape[0] < WS_LANES * m:
+            cap = 64
+            while cap < m:
+                cap *= 2
+            ws = self._ws = np.empty(WS_LANES * cap, dtype=np.int64)
+        ws[:m] = word_ids
+        n = _bpe_encode_nb(ws, m, self._pair_keys, self._pair_vals)
+        return self._translate_out(orig, ws[:n].tolist())
 
     def process_lines(self, filename, outfile, dropout=0, num_workers=1):
-        _process_lines(self, filename, outfile, dropout, 0, 0)
+        if num_workers is None or num_workers < 1:
+            num_workers = cpu_count()
+
+        if num_workers == 1:
+            _process_lines(self, filename, outfile, dropout, 0, 0)
+            return
+
+        # split the file into num_workers byte ranges aligned to newline
+        # boundaries; each worker seeks to its range and writes a shard
+        size = os.stat(filename).st_size
+        offsets = [0] * (num_workers + 1)
+        offsets[num_workers] = size
+        with open(filename, 'rb') as f:
+            for i in range(1, num_workers):
+                f.seek(size * i // num_workers)
+                f.readline()  # advance to the next newline boundary
+                offsets[i] = f.tell()
+
+        res_files = []
+        results = []
+        pool = Pool(processes=num_workers)
+        for i in range(num_workers):
+            tmp = tempfile.NamedTemporaryFile(delete=False)
+            tmp.close()
+            res_files.append(tmp.name)
+            results.append(pool.apply_async(_process_lines, (self, filename, tmp.name, dropout, offsets[i], offsets[i + 1])))
+        pool.close()
+        pool.join()
+        for result in results:
+            # re-raise any worker exception instead of silently
+            # concatenating an incomplete shard
+            result.get()
+
+        if isinstance(outfile, str):
+            fo = open(outfile, "w", encoding="utf-8")
+        else:
+            fo = outfile
+        for name in res_files:
+            with open(name, encoding="utf-8") as fi:
+                shutil.copyfileobj(fi, fo)
+            os.remove(name)
+        if isinstance(outfile, str):
+            fo.close()
 
     def process_line(self, line, dropout=0):
         """segment line, dealing with leading and trailing whitespace"""
 
+        # repeated lines (imports, boilerplate) skip tokenization entirely
+        if not dropout:
+            cached = self.line_cache.get(line)
+            if cached is not None:
+                return cached
+
         out = ""
 
         leading_whitespace = len(line)-len(line.lstrip('\r\n '))
@@ -69,61 +553,149 @@ class BPE(object):
         if trailing_whitespace and trailing_whitespace != len(line):
             out += line[-trailing_whitespace:]
 
+        if not dropout:
+            self.line_cache[line] = out
+
         return out
 
     def segment(self, sentence, dropout=0):
         """segment single sentence (whitespace-tokenized string) with BPE encoding"""
-        segments = self.segment_tokens(sentence.strip('\r\n ').split(' '), dropout)
-        return ' '.join(segments)
+        # joining each word's subwords with 'separator + space' produces the
+        # output string directly, without a per-item string concat
+        sep_join = (self.separator + ' ').join
+        return ' '.join(map(sep_join, self._word_pieces(sentence.strip('\r\n ').split(' '), dropout)))
 
     def segment_tokens(self, tokens, dropout=0):
         """segment a sequence of tokens with BPE encoding"""
         output = []
+        append = output.append
+        separator = self.separator
+        for new_word in self._word_pieces(tokens, dropout):
+            for item in new_word[:-1]:
+                append(item + separator)
+            append(new_word[-1])
+
+        return output
+
+    def _word_pieces(self, tokens, dropout=0):
+        """yield the subword list of each non-empty token"""
+        # bind the per-word callables and attributes once outside the loop
+        isolate_glossaries = self._isolate_glossaries
+        encode_fast = self._encode_fast
+        if dropout:
+            # dropout needs to resample pairs on every merge, so it stays
+            # on the interpreted path
+            for word in tokens:
+                # eliminate double spaces
+                if not word:
+                    continue
+                yield [out for segment in isolate_glossaries(word)
+                       for out in encode(segment,
+                                         self.bpe_codes,
+                                         self.bpe_codes_reverse if self.vocab else None,
+                                         self.vocab,
+                                         self.separator,
+                                         self.version,
+                                         self.cache,
+                                         self.glossaries_regex,
+                                         dropout)]
+
+            return
+
+        # gather every uncached segment first so one parallel kernel call
+        # covers the whole token sequence; cache hits skip straight to the
+        # assembly loop below
+        cache = self.cache
+        glossaries_regex = self.glossaries_regex
+        word_segments = []
+        pending = []
+        pending_set = set()
         for word in tokens:
             # eliminate double spaces
             if not word:
                 continue
-            new_word = [out for segment in self._isolate_glossaries(word)
-                        for out in encode(segment,
-                                          self.bpe_codes,
-                                          self.bpe_codes_reverse,
-                                          self.vocab,
-                                          self.separator,
-                                          self.version,
-                                          self.cache,
-                                          self.glossaries_regex,
-                                          dropout)]
-
-            for item in new_word[:-1]:
-                output.append(item + self.separator)
-            output.append(new_word[-1])
-
-        return output
+            segments = isolate_glossaries(word)
+            word_segments.append(segments)
+            for segment in segments:
+                if (len(segment) > 1 and segment not in cache and segment not in pending_set
+                        and not (glossaries_regex and glossaries_regex.fullmatch(segment))):
+                    pending_set.add(segment)
+                    pending.append(segment)
+        if len(pending) > 1:
+            self._encode_batch(pending)
+
+        for segments in word_segments:
+            yield [out for segment in segments for out in encode_fast(segment)]
 
     def _isolate_glossaries(self, word):
-        word_segments = [word]
-        for gloss in self.glossaries:
-            word_segments = [out_segments for segment in word_segments
-                                 for out_segments in isolate_glossary(segment, gloss)]
+        if not self.glossaries:
+            return [word]
+        cached = self._gloss_cache.get(word)
+        if cached is not None:
+            return cached
+        if not self._gloss_search.search(word):
+            # common case: no glossary occurs in the word
+            word_segments = [word]
+        else:
+            word_segments = [word]
+            for gloss_res in self._gloss_res:
+                if isinstance(gloss_res, str):
+                    word_segments = [out_segments for segment in word_segments
+                                         for out_segments in _isolate_glossary_literal(segment, gloss_res)]
+                else:
+                    word_segments = [out_segments for segment in word_segments
+                                         for out_segments in _isolate_glossary_compiled(segment, gloss_res)]
+        self._gloss_cache[word] = word_segments
         return word_segments
 
 
+# read size for _process_lines; one syscall per megabyte instead of one
+# readline per line
+READ_CHUNK = 1 << 20
+
 def _process_lines(bpe, filename, outfile, dropout, begin, end):
-    if isinstance(outfile, str):
-        fo = open(outfile, "w", encoding="utf-8")
+    # when we own the output file, keep it binary and write each batch as
+    # one encoded block; a caller-supplied handle gets the joined text
+    own_output = isinstance(outfile, str)
+    if own_output:
+        fo = open(outfile, "wb")
     else:
         fo = outfile
-    with open(filename, encoding="utf-8") as f:
+    # read the file in large binary chunks and split on '\n' ourselves;
+    # stripping a trailing '\r' afterwards matches the universal-newline
+    # translation the old text-mode readline applied to CRLF input (a
+    # lone '\r' is not treated as a line break). Byte offsets stay exact
+    # for the begin/end range used by the parallel workers
+    with open(filename, 'rb') as f:
         f.seek(begin)
-        line = f.readline()
-        while line:
-            pos = f.tell()
-            assert 0 <= pos < 1e20, "Bad new line separator, e.g. '\\r'"
-            if end > 0 and pos > end:
+        pos = begin
+        tail = b''
+        done = False
+        while not done:
+            chunk = f.read(READ_CHUNK)
+            if not chunk:
                 break
-            fo.write(bpe.process_line(line, dropout))
-            line = f.readline()
-    if isinstance(outfile, str):
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()
+            outs = []
+            for line in lines:
+                pos += len(line) + 1
+                if end > 0 and pos > end:
+                    done = True
+                    break
+                if line.endswith(b'\r'):
+                    line = line[:-1]
+                outs.append(bpe.process_line(line.decode('utf-8') + '\n', dropout))
+            if outs:
+                # one write per input chunk instead of one per line
+                out = ''.join(outs)
+                fo.write(out.encode('utf-8') if own_output else out)
+        if tail and not done:
+            pos += len(tail)
+            if not (end > 0 and pos > end):
+                out = bpe.process_line(tail.decode('utf-8'), dropout)
+                fo.write(out.encode('utf-8') if own_output else out)
+    if own_output:
         fo.close()
 
 def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache, glossaries_regex=None, dropout=0):
@@ -133,7 +705,7 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
     if not dropout and orig in cache:
         return cache[orig]
 
-    if glossaries_regex and glossaries_regex.match(orig):
+    if glossaries_regex and glossaries_regex.fullmatch(orig):
         cache[orig] = (orig,)
         return (orig,)
 
@@ -141,38 +713,63 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
         return orig
 
     if version == (0, 1):
-        word = list(orig) + ['</w>']
+        word = list(orig)
+        word.append('</w>')
     elif version == (0, 2): # more consistent handling of word-final segments
-        word = list(orig[:-1]) + [orig[-1] + '</w>']
+        word = list(orig[:-1])
+        word.append(orig[-1] + '</w>')
     else:
         raise NotImplementedError
 
-    while len(word) > 1:
+    get_rank = bpe_codes.get
+    rand = random.random
 
-        # get list of symbol pairs; optionally apply dropout
-        pairs = [(bpe_codes[pair],i,pair) for (i,pair) in enumerate(zip(word, word[1:])) if (not dropout or random.random() > dropout) and pair in bpe_codes]
+    while len(word) > 1:
 
-        if not pairs:
+        # single pass over adjacent pairs: track the lowest-rank pair and
+        # its start positions directly instead of materializing a tuple
+        # list and calling min() on it; optionally apply dropout
+        best_rank = None
+        bigram = None
+        positions = []
+        for i in range(len(word) - 1):
+            if dropout and rand() <= dropout:
+                continue
+            pair = (word[i], word[i+1])
+            rank = get_rank(pair)
+            if rank is None:
+                continue
+            if best_rank is None or rank < best_rank:
+                best_rank = rank
+                bigram = pair
+                positions = [i]
+            elif pair == bigram:
+                positions.append(i)
+
+        if best_rank is None:
             break
 
-        #get first merge operation in list of BPE codes
-        bigram = min(pairs)[2]
-
-        # find start position of all pairs that we want to merge
-        positions = [i for (rank,i,pair) in pairs if pair == bigram]
-
+        # compact the merges into word itself instead of building a new list
+        # every iteration; the write index never overtakes the read index
         i = 0
-        new_word = []
+        w = 0
         bigram = ''.join(bigram)
         for j in positions:
             # merges are invalid if they start before current position. This can happen if there are overlapping pairs: (x x x -> xx x)
             if j < i:
                 continue
-            new_word.extend(word[i:j]) # all symbols before merged pair
-            new_word.append(bigram) # merged pair
+            while i < j: # all symbols before merged pair
+                word[w] = word[i]
+                w += 1
+                i += 1
+            word[w] = bigram # merged pair
+            w += 1
             i = j+2 # continue after merged pair
-        new_word.extend(word[i:]) # add all symbols until end of word
-        word = new_word
+        while i < len(word): # add all symbols until end of word
+            word[w] = word[i]
+            w += 1
+            i += 1
+        del word[w:]
 
     # don't print end-of-word symbols
     if word[-1] == '</w>':
@@ -238,6 +835,38 @@ def check_vocab_and_split(orig, bpe_codes, vocab, separator):
 
     return out
 
+def _isolate_glossary_literal(word, glossary):
+    """isolate_glossary for a glossary with no regex metacharacters: plain
+    substring scanning instead of regex match/search/split"""
+    if word == glossary or glossary not in word:
+        return [word]
+    segments = []
+    start = 0
+    glen = len(glossary)
+    while True:
+        j = word.find(glossary, start)
+        if j < 0:
+            break
+        if j > start:
+            segments.append(word[start:j])
+        segments.append(glossary)
+        start = j + glen
+    ending = word[start:]
+    if ending != '':
+        segments.append(ending.strip('\r\n '))
+    return segments
+
+def _isolate_glossary_compiled(word, gloss_res):
+    """isolate_glossary over (match, search, split) patterns compiled once in BPE.__init__"""
+    match_re, search_re, split_re = gloss_res
+    if match_re.match(word) or not search_re.search(word):
+        return [word]
+    else:
+        segments = split_re.split(word)
+        segments, ending = segments[:-1], segments[-1]
+        segments = list(filter(None, segments)) # Remove empty strings in regex group.
+        return segments + [ending.strip('\r\n ')] if ending != '' else segments
+
 def isolate_glossary(word, glossary):
     """
     Isolate a glossary present inside a word.
@@ -259,12 +888,9 @@ def isolate_glossary(word, glossary):
 
 def apply(codes, infile, outfile, vocabulary=None, merges=-1, separator='@@', glossaries=None, dropout=0):
 # def apply(codes, infile, outfile, vocabulary=None, merges=-1, separator='</w>', glossaries=None, dropout=0):
-    codes = codecs.open(codes, encoding='utf-8')
-    input = codecs.open(infile, encoding='utf-8')
-    output = codecs.open(outfile, 'w', encoding='utf-8')
-    bpe = BPE(codes, merges, separator, vocabulary, glossaries)
-    for line in input:
-        output.write(bpe.process_line(line, dropout))
+    with open(codes, encoding='utf-8') as codes_file:
+        bpe = BPE(codes_file, merges, separator, vocabulary, glossaries)
+    bpe.process_lines(infile, outfile, dropout)
 
 if __name__ == '__main__':
     # projects = ['closure-compiler', 'deeplearning4j', 'druid', 'flink', 'jenkins', 'storm', 'robolectric', 'graylog2-server', 'jetty.project',